@@ -10,15 +10,28 @@ import os
 try:
     import machine
     gettime = lambda: time.ticks_ms()
+    ticks_diff = time.ticks_diff
     SOCK_TIMEOUT = 0
 except ImportError:
     const = lambda x: x
     gettime = lambda: int(time.time() * 1000)
+    ticks_diff = lambda a, b: a - b
     SOCK_TIMEOUT = 0.05
 
 def dummy(*args):
     pass
 
+# Message header: cmd, msg id, length
+try:
+    _HDR = struct.Struct("!BHH")
+except AttributeError:
+    # MicroPython's ustruct has no Struct class
+    class _HDR:
+        size = 5
+        pack = lambda *v: struct.pack("!BHH", *v)
+        pack_into = lambda buf, off, *v: struct.pack_into("!BHH", buf, off, *v)
+        unpack_from = lambda buf, off=0: struct.unpack_from("!BHH", buf, off)
+
 MSG_RSP = const(0)
 MSG_LOGIN = const(2)
 MSG_PING  = const(6)
@@ -50,7 +63,15 @@ print("""
  /____/_/\\_, /_//_/_/\\_\\
         /___/ for Python v""" + __version__ + " (" + sys.platform + ")\n")
 
+def _encode_args(args):
+    return b'\0'.join([a.encode('utf8') if isinstance(a, str) else
+                       b'%d' % a if type(a) is int else
+                       a if isinstance(a, (bytes, bytearray)) else
+                       str(a).encode('utf8') for a in args])
+
 class EventEmitter:
+    __slots__ = ('_cbks',)
+
     def __init__(self):
         self._cbks = {}
 
@@ -63,27 +84,75 @@ class EventEmitter:
                 return f
             return D
 
-    def emit(self, evt, *a, **kv):
-        if evt in self._cbks:
-            self._cbks[evt](*a, **kv)
+    def emit(self, evt, *a):
+        cb = self._cbks.get(evt)
+        if cb is not None:
+            cb(*a)
 
 
 class BlynkProtocol(EventEmitter):
-    def __init__(self, auth, tmpl_id=None, fw_ver=None, heartbeat=50, buffin=1024, log=None):
+    __slots__ = ('_heartbeat', 'buffin', '_log_fn', '_log', 'auth', 'tmpl_id', 'fw_ver',
+                 'state', 'conn', '_dispatch', 'msg_id', 'lastRecv', 'lastSend',
+                 'lastPing', 'bin', '_pos', '_retry_delay', '_last_fail',
+                 '_hb_timeout', '_hb_ping', '_vkeys')
+
+    def __init__(self, auth, tmpl_id=None, fw_ver=None, heartbeat=50, buffin=4096, log=None):
         EventEmitter.__init__(self)
         self.heartbeat = heartbeat*1000
         self.buffin = buffin
-        self.log = log or print # Changed default to print for better debugging
+        self.log = log
         self.auth = auth
         self.tmpl_id = tmpl_id
         self.fw_ver = fw_ver
         self.state = DISCONNECTED
         self.conn = None # Add conn attribute to base class
+        self._dispatch = {
+            MSG_PING: self._on_ping,
+            MSG_HW: self._on_hw,
+            MSG_BRIDGE: self._on_hw,
+            MSG_INTERNAL: self._on_internal,
+            MSG_REDIRECT: self._on_redirect,
+        }
+        self._retry_delay = 1000
+        self._last_fail = None # Time of the last failed connect, if backing off
+        self._vkeys = {} # raw pin -> ("Vn", "n")
         self.connect()
 
+    @property
+    def heartbeat(self):
+        return self._heartbeat
+
+    @heartbeat.setter
+    def heartbeat(self, value):
+        # In ms; keep the thresholds derived from it in step
+        self._heartbeat = value
+        self._hb_timeout = value + value//2
+        self._hb_ping = value//10
+
+    @property
+    def log(self):
+        return self._log_fn
+
+    @log.setter
+    def log(self, value):
+        self._log_fn = value or dummy
+        self._log = self._log_fn is not dummy # Skip building per-message log args when silent
+
     def virtual_write(self, pin, *val):
         self._send(MSG_HW, 'vw', pin, *val)
 
+    def virtual_write_int(self, pin, value):
+        # Fast path for the common single integer write
+        if self.state == DISCONNECTED:
+            self.log('Skip send: not connected')
+            return
+        id = self._next_msg_id()
+        data = b'vw\0%d\0%d' % (pin, value)
+        if self._log:
+            self.log('<', MSG_HW, id, '|', 'vw', pin, value)
+        self.lastSend = gettime()
+        self._write(_HDR.pack(MSG_HW, id, len(data)) + data)
+
     def send_internal(self, pin, *val):
         self._send(MSG_INTERNAL,  pin, *val)
 
@@ -96,6 +165,11 @@ class BlynkProtocol(EventEmitter):
     def log_event(self, *val):
         self._send(MSG_EVENT_LOG, *val)
 
+    def _next_msg_id(self):
+        # msg_id is the last id used; ids cycle through 1..0xFFFF, never 0
+        self.msg_id = id = self.msg_id % 0xFFFF + 1
+        return id
+
     def _send(self, cmd, *args, **kwargs):
         if self.state == DISCONNECTED: # fixed stupid mistake
              self.log('Skip send: not connected')
@@ -104,34 +178,38 @@ class BlynkProtocol(EventEmitter):
         if 'id' in kwargs:
             id = kwargs.get('id')
         else:
-            id = self.msg_id
-            self.msg_id += 1
-            if self.msg_id > 0xFFFF:
-                self.msg_id = 1
+            id = self._next_msg_id()
                 
         if cmd == MSG_RSP:
             data = b''
             dlen = args[0]
         else:
-            data = ('\0'.join(map(str, args))).encode('utf8')
+            data = _encode_args(args)
             dlen = len(data)
         
-        self.log('<', cmd, id, '|', *args)
-        msg = struct.pack("!BHH", cmd, id, dlen) + data
+        if self._log:
+            self.log('<', cmd, id, '|', *args)
+        # Header and payload in one buffer: one write, one TLS record
+        msg = bytearray(5 + len(data))
+        _HDR.pack_into(msg, 0, cmd, id, dlen)
+        if data:
+            msg[5:] = data
         self.lastSend = gettime()
         self._write(msg)
 
     def connect(self):
         if self.state != DISCONNECTED: return
-        self.msg_id = 1
+        self.msg_id = 0 # Login goes out as id 1
         (self.lastRecv, self.lastSend, self.lastPing) = (gettime(), 0, 0)
-        self.bin = b""
+        self.bin = bytearray()
+        self._pos = 0
         self.state = CONNECTING
         self._send(MSG_HW_LOGIN, self.auth)
 
     def disconnect(self):
         if self.state == DISCONNECTED: return
-        self.bin = b""
+        self.bin = bytearray()
+        self._pos = 0
         self.state = DISCONNECTED
         self.emit('disconnected')
         self.log('Disconnected.')
@@ -143,9 +221,48 @@ class BlynkProtocol(EventEmitter):
                 pass
             self.conn = None
 
+    def _on_ping(self, i, data):
+        self._send(MSG_RSP, STA_SUCCESS, id=i)
+
+    # Payloads are split as bytes; values are decoded only if someone listens
+
+    def _on_hw(self, i, data):
+        args = data.split(b'\0')
+        if args[0] != b'vw':
+            return
+        keys = self._vkeys.get(args[1])
+        if keys is None:
+            pin = args[1].decode('utf8')
+            keys = ("V"+pin, pin)
+            if len(self._vkeys) < 256: # Server-controlled, so keep it bounded
+                self._vkeys[args[1]] = keys
+        cb = self._cbks.get(keys[0])
+        cb_any = self._cbks.get("V*")
+        if cb is None and cb_any is None:
+            return
+        vals = [a.decode('utf8') for a in args[2:]]
+        if cb is not None:
+            # Each listener gets its own list, in case one modifies it
+            cb(vals[:] if cb_any is not None else vals)
+        if cb_any is not None:
+            cb_any(keys[1], vals)
+
+    def _on_internal(self, i, data):
+        args = data.split(b'\0')
+        cb = self._cbks.get("internal:"+args[0].decode('utf8'))
+        if cb is not None:
+            cb([a.decode('utf8') for a in args[1:]])
+
+    def _on_redirect(self, i, data):
+        args = data.split(b'\0')
+        self.emit("redirect", args[0].decode('utf8'), int(args[1]))
+
     def process(self, data=None):
         # NEW: Auto-reconnect logic
         if self.state == DISCONNECTED:
+            if (self._last_fail is not None and
+                ticks_diff(gettime(), self._last_fail) < self._retry_delay):
+                return # Backing off
             self.log('Trying to reconnect...')
             self.connect()
             return # Wait for next cycle
@@ -153,39 +270,58 @@ class BlynkProtocol(EventEmitter):
         if not (self.state == CONNECTING or self.state == CONNECTED): return
         
         now = gettime()
+
+        # Nothing to parse and nothing due: recent traffic both ways means
+        # neither the heartbeat timeout nor a ping can trigger yet
+        if (not data and not self.bin and
+            now - self.lastSend < self._hb_ping and
+            now - self.lastRecv < self._hb_ping):
+            return
         
         # Heartbeat check
-        if now - self.lastRecv > self.heartbeat+(self.heartbeat//2):
+        if now - self.lastRecv > self._hb_timeout:
             self.log('Heartbeat timeout.')
             return self.disconnect()
         
         # Ping check
-        if (now - self.lastPing > self.heartbeat//10 and
+        if (now - self.lastPing > self._hb_ping and
             self.state == CONNECTED and # Only ping if fully connected
-            (now - self.lastSend > self.heartbeat or
-             now - self.lastRecv > self.heartbeat)):
+            (now - self.lastSend > self._heartbeat or
+             now - self.lastRecv > self._heartbeat)):
             self._send(MSG_PING)
             self.lastPing = now
         
+        buf = self.bin
         if data != None and len(data):
-            self.bin += data
-
-        while True:
-            if len(self.bin) < 5:
-                break
-
-            cmd, i, dlen = struct.unpack("!BHH", self.bin[:5])
+            buf.extend(data)
+
+        # The loop works on locals; self.bin being replaced means a handler
+        # disconnected, so stop parsing the old buffer.
+        end = len(buf)
+        pos = self._pos
+        if end - pos < 5:
+            return # No complete header yet
+        unpack = _HDR.unpack_from
+        dispatch = self._dispatch
+        log = self.log if self._log else None
+        got_frame = False
+        while end - pos >= 5:
+            cmd, i, dlen = unpack(buf, pos)
             if i == 0: 
                 self.log('Invalid message ID.')
                 return self.disconnect()
                       
-            self.lastRecv = now
+            if not got_frame:
+                got_frame = True
+                self.lastRecv = now
             if cmd == MSG_RSP:
-                self.bin = self.bin[5:]
+                pos += 5
 
-                self.log('>', cmd, i, '|', dlen)
+                if log:
+                    log('>', cmd, i, '|', dlen)
                 if self.state == CONNECTING and i == 1:
                     if dlen == STA_SUCCESS:
+                        self._pos = pos # Consumed, even if a callback raises
                         self.state = CONNECTED
                         dt = now - self.lastSend
                         info = ['ver', __version__, 'h-beat', self.heartbeat//1000, 'buff-in', self.buffin, 'dev', sys.platform+'-py']
@@ -196,10 +332,11 @@ class BlynkProtocol(EventEmitter):
                             info.extend(['fw', self.fw_ver])
                         self._send(MSG_INTERNAL, *info)
                         try:
-                            self.emit('connected', ping=dt)
+                            self.emit('connected', dt)
                         except TypeError:
                             self.emit('connected')
                         self.log('Connected!')
+                        if self.bin is not buf: return
                     else:
                         if dlen == STA_INVALID_TOKEN:
                             self.emit("invalid_auth")
@@ -210,37 +347,44 @@ class BlynkProtocol(EventEmitter):
                     self.log("Cmd too big: ", dlen)
                     return self.disconnect()
 
-                if len(self.bin) < 5+dlen:
+                if end - pos < 5+dlen:
                     break
 
-                data = self.bin[5:5+dlen:]
-                self.bin = self.bin[5+dlen:]
-
-                args = list(map(lambda x: x.decode('utf8'), data.split(b'\0')))
-
-                self.log('>', cmd, i, '|', ','.join(args))
-                if cmd == MSG_PING:
-                    self._send(MSG_RSP, STA_SUCCESS, id=i)
-                elif cmd == MSG_HW or cmd == MSG_BRIDGE:
-                    if args[0] == 'vw':
-                        self.emit("V"+args[1], args[2:])
-                        self.emit("V*", args[1], args[2:])
-                elif cmd == MSG_INTERNAL:
-                    self.emit("internal:"+args[0], args[1:])
-                elif cmd == MSG_REDIRECT:
-                    self.emit("redirect", args[0], int(args[1]))
-                else:
+                pos += 5+dlen
+                # Temporary view, so the payload is copied once. It must not
+                # outlive this line: CPython can't resize an exported bytearray
+                data = bytes(memoryview(buf)[pos-dlen:pos])
+
+                if log:
+                    log('>', cmd, i, '|', data.replace(b'\0', b',').decode('utf8'))
+                h = dispatch.get(cmd)
+                if h is None:
                     self.log("Unexpected command: ", cmd)
                     return self.disconnect()
+                self._pos = pos # Consumed, even if the handler raises
+                h(i, data)
+                if self.bin is not buf: return
+
+        # Drop consumed bytes only once in a while, not per message
+        if pos and (pos > 512 or pos == end):
+            self.bin = buf[pos:]
+            pos = 0
+        self._pos = pos
 
 import socket
 
 class Blynk(BlynkProtocol):
+    __slots__ = ('insecure', 'server', 'port', '_recv_buf', '_recv_mv', '_quickack')
+
     def __init__(self, auth, **kwargs):
         self.insecure = kwargs.pop('insecure', False)
         self.server = kwargs.pop('server', 'blynk.cloud')
         self.port = kwargs.pop('port', 80 if self.insecure else 443)
+        self._quickack = False # Whether TCP_QUICKACK is supported on conn
         BlynkProtocol.__init__(self, auth, **kwargs)
+        # Reused for every read; process() copies what it keeps
+        self._recv_buf = bytearray(self.buffin)
+        self._recv_mv = memoryview(self._recv_buf)
         self.on('redirect', self.redirect)
 
     def redirect(self, server, port):
@@ -257,13 +401,25 @@ class Blynk(BlynkProtocol):
         self.log('Connecting to %s:%d...' % (self.server, self.port))
         
         # NEW: Wrap entire connection in try/except
+        s = None
         try:
             s = socket.socket()
+            try:
+                # Set before connect, so the advertised TCP window matches
+                s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, max(8192, self.buffin*4))
+            except:
+                pass
             s.connect(socket.getaddrinfo(self.server, self.port)[0][-1])
             try:
                 s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
             except:
                 pass
+            try:
+                # Not sticky on Linux, so _read() re-arms it after each read
+                s.setsockopt(socket.IPPROTO_TCP, socket.TCP_QUICKACK, 1)
+                self._quickack = True
+            except:
+                self._quickack = False
             
             if self.insecure:
                 self.conn = s
@@ -283,42 +439,83 @@ class Blynk(BlynkProtocol):
             
             # Call base protocol connect ONLY if socket connection was successful
             BlynkProtocol.connect(self)
+            self._last_fail = None
+            self._retry_delay = 1000
             
         except Exception as e:
             self.log('Error connecting:', str(e))
             self.state = DISCONNECTED # Ensure we are marked as disconnected
-            # Wait before retrying so we don't spam
-            print("network has lost we're going to reset the machine!")
-            print("Rebooting in 5 seconds...")
-            time.sleep(5)  # Add a delay to prevent a fast crash-reboot loop
-            machine.reset() # Perform a hard reset 
+            if s:
+                try:
+                    s.close()
+                except:
+                    pass
+            self.conn = None
+            # Back off without blocking; process() retries once it's due.
+            # Elapsed time is compared wrap-safe, as ticks_ms() wraps around.
+            if self._last_fail is not None:
+                self._retry_delay = min(self._retry_delay * 2, 60000)
+            self._last_fail = gettime()
 
     def _write(self, data):
+        # data may be any bytes-like object
         #print('<', data)
         try:
-            self.conn.write(data)
+            # MicroPython and ssl sockets have write, plain CPython sockets sendall
+            conn = self.conn
+            (getattr(conn, 'write', None) or conn.sendall)(data)
         except Exception as e:
             # Handle write error (e.g., connection dropped)
             self.log('Write error:', str(e))
             self.disconnect()
 
-    def run(self):
-        data = b''
+    def _read(self):
+        # Fill the receive buffer with whatever is queued, without allocating.
+        # Returns the byte count, or None if the connection failed.
+        n = 0
         try:
-            # Check if connection exists before reading
-            if self.conn:
-                data = self.conn.read(self.buffin)
-            #print('>', data)
+            conn = self.conn
+            if conn:
+                # MicroPython streams have readinto, CPython sockets recv_into
+                readinto = getattr(conn, 'readinto', None) or conn.recv_into
+                pending = getattr(conn, 'pending', None)
+                while n < len(self._recv_buf):
+                    k = readinto(self._recv_mv[n:])
+                    if k == 0:
+                        # Peer closed; MicroPython reports "no data" as None
+                        self.log('Connection closed by server')
+                        self.disconnect() # process() will reconnect
+                        return None
+                    #print('>', bytes(self._recv_mv[n:n+k]))
+                    if not k:
+                        break
+                    n += k
+                    if not (pending and pending()):
+                        break
         except KeyboardInterrupt:
             raise # Allow user to stop the program
         except OSError:
-            # No data received, this is normal
+            # No (more) data received, this is normal
             pass
         except Exception as e: 
             # NEW: Catch other errors (e.g. connection reset)
             self.log('Read error:', str(e))
             self.disconnect() # Force disconnect, process() will reconnect
-            return # Skip processing this cycle
-            
-        # process() will handle pings, data, and reconnect logic
-        self.process(data)
+            return None
+        if n and self._quickack:
+            try:
+                self.conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_QUICKACK, 1)
+            except:
+                self._quickack = False
+        return n
+
+    def run(self):
+        # Drain everything queued; a full buffer means more may be waiting
+        while True:
+            n = self._read()
+            if n is None:
+                return # Skip processing this cycle
+            # process() will handle pings, data, and reconnect logic
+            self.process(self._recv_mv[:n])
+            if n < len(self._recv_buf):
+                break